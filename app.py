@@ -8,15 +8,34 @@
 # 下一步的关键是在 Cloud Run 中设置"最小实例"为 1 来彻底解决冷启动超时问题。
 # -----------------------------------------------------------------------------
 import os
+import re
+import sys
+import copy
+import json
+import uuid
+import queue
+import atexit
+import logging
+import logging.handlers
+import zlib
+import zipfile
 import datetime
+import hashlib
+import threading
+import time
 import jwt
-import traceback
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
 
 import google.generativeai as genai
-from flask import Flask, request, jsonify, url_for, redirect
+from flask import Flask, request, jsonify, url_for, redirect, Response, stream_with_context, g, has_request_context
+from flask.logging import default_handler
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect as sa_inspect, text as sa_text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
 from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadTimeSignature
@@ -40,6 +59,156 @@ app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_recycle': 280, 'pool_pre_ping': True}
 
+# --- 日志配置 ---
+# 结构化 JSON 日志：请求线程只把日志放进队列，由后台线程统一写入 stdout（Cloud Logging 会按 JSON 解析）。
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = 10000 # 队列满时直接丢弃新日志，绝不阻塞请求线程
+LOG_SAMPLE_WINDOW_SECONDS = 60
+LOG_SAMPLE_BURST = 10 # 同一类错误在每个窗口内完整记录的条数
+LOG_SAMPLE_EVERY = 100 # 超出后每 N 条只记录 1 条，并附带被省略的条数
+SLOW_REQUEST_MS = int(os.environ.get('SLOW_REQUEST_MS', 3000)) # 超过该耗时的请求会记录分阶段耗时
+LOG_EXTRA_FIELDS = ('request_id', 'method', 'path', 'status', 'duration_ms', 'timings_ms', 'error_class', 'suppressed')
+LOG_STATS = {'enqueued': 0, 'dropped': 0, 'sampled_out': 0} # 近似计数，用于评估日志量
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'severity': record.levelname,
+            'message': record.getMessage(),
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'logger': record.name,
+        }
+        for field in LOG_EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.path = request.path
+        return True
+
+class ErrorSamplingFilter(logging.Filter):
+    """按错误类别限流，避免故障期间（如模型服务中断）每个请求都刷出一整段堆栈。"""
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._windows = {} # key -> [窗口开始时间, 本窗口计数, 被省略的条数]
+
+    def filter(self, record):
+        if record.levelno < logging.ERROR:
+            return True
+        if record.exc_info and record.exc_info[0]:
+            record.error_class = record.exc_info[0].__name__
+        key = (str(record.msg), getattr(record, 'error_class', None))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= LOG_SAMPLE_WINDOW_SECONDS:
+                if window and window[2]:
+                    record.suppressed = window[2]
+                if len(self._windows) >= 1000:
+                    self._windows.clear()
+                window = self._windows[key] = [now, 0, 0]
+            window[1] += 1
+            if window[1] <= LOG_SAMPLE_BURST or window[1] % LOG_SAMPLE_EVERY == 0:
+                if window[2]:
+                    record.suppressed, window[2] = window[2], 0
+                return True
+            window[2] += 1
+        LOG_STATS['sampled_out'] += 1
+        return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # 请求线程中只展开消息参数、把异常转成文本；JSON 序列化与写出在后台线程完成
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            LOG_STATS['enqueued'] += 1
+        except queue.Full:
+            LOG_STATS['dropped'] += 1
+
+logger = logging.getLogger('plot_ark')
+logger.setLevel(LOG_LEVEL)
+logger.propagate = False
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_queue_handler = NonBlockingQueueHandler(_log_queue)
+_queue_handler.addFilter(ErrorSamplingFilter())
+_queue_handler.addFilter(RequestContextFilter())
+logger.addHandler(_queue_handler)
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(JsonLogFormatter())
+_log_listener = logging.handlers.QueueListener(_log_queue, _stdout_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop) # 退出前把队列中剩余的日志写完
+
+# Flask 用 app.logger 记录未捕获的异常，同样走 JSON 队列，而不是直接向 stderr 输出堆栈
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(_queue_handler)
+app.logger.setLevel(LOG_LEVEL)
+app.logger.propagate = False
+
+def add_request_timing(phase, seconds):
+    if has_request_context() and 'timings' in g:
+        g.timings[phase] = g.timings.get(phase, 0.0) + seconds
+
+@contextmanager
+def timed(phase):
+    """把代码块耗时累加到当前请求的某个阶段（auth / db / model / serialize）。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_request_timing(phase, time.perf_counter() - start)
+
+_REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+@app.before_request
+def start_request_logging():
+    request_id = request.headers.get('X-Request-ID') or request.headers.get('X-Cloud-Trace-Context', '').split('/')[0]
+    g.request_id = request_id if _REQUEST_ID_RE.match(request_id or '') else uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+    g.timings = {}
+
+def log_slow_request(method, path, request_id, status, request_start, timings):
+    duration_ms = (time.perf_counter() - request_start) * 1000
+    if duration_ms >= SLOW_REQUEST_MS:
+        timings_ms = {phase: round(seconds * 1000, 1) for phase, seconds in timings.items()}
+        # 流式响应结束时请求上下文可能已不存在，因此显式传入请求信息
+        logger.warning("慢请求: %s %s 耗时 %.0fms", method, path, duration_ms,
+                       extra={'request_id': request_id, 'method': method, 'path': path, 'status': status,
+                              'duration_ms': round(duration_ms, 1), 'timings_ms': timings_ms})
+
+@app.after_request
+def finish_request_logging(response):
+    # 限流器等前置钩子可能先于本模块的 before_request 返回，因此这里的字段都可能不存在
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    if 'request_start' in g:
+        log_args = (request.method, request.path, g.get('request_id'), response.status_code, g.request_start, g.timings)
+        if response.is_streamed:
+            # after_request 在流式响应体发送之前执行，等响应关闭（全部数据发送完毕）后再记录完整耗时
+            response.call_on_close(lambda: log_slow_request(*log_args))
+        else:
+            log_slow_request(*log_args)
+    return response
+
+
 # --- 限流器配置 ---
 limiter = Limiter(
     app=app, # 明确指定app为关键字参数
@@ -49,9 +218,50 @@ limiter = Limiter(
 )
 
 
+# --- Token 预算配置 ---
+# 按订阅等级限制单次生成的输入/输出规模，在调用模型之前就拦截超大请求。
+# - max_setting_tokens: 单个角色设定的目标上限，超出部分会被自动摘要或截断
+# - max_raw_setting_tokens: 单个角色设定的硬上限，超出直接拒绝（避免为摘要本身付费）
+# - max_prompt_tokens: 核心梗的上限，核心梗不做压缩，超出直接拒绝
+# - max_input_tokens: 整个Prompt（含模板）的总上限，刻意小于各字段上限之和，各字段不能同时取满
+# - max_output_tokens: 传给模型的输出上限。gemini-2.5 的思考 token 也计入其中，
+#   因此在大纲本身约 2000 token 的基础上为思考预留了充足空间
+TOKEN_BUDGETS = {
+    'guest': {'max_setting_tokens': 800, 'max_raw_setting_tokens': 6000, 'max_prompt_tokens': 500,
+              'max_input_tokens': 2200, 'max_output_tokens': 8192},
+    'free': {'max_setting_tokens': 1500, 'max_raw_setting_tokens': 12000, 'max_prompt_tokens': 1000,
+             'max_input_tokens': 3500, 'max_output_tokens': 12288},
+    'pro': {'max_setting_tokens': 4000, 'max_raw_setting_tokens': 30000, 'max_prompt_tokens': 2000,
+            'max_input_tokens': 8000, 'max_output_tokens': 16384},
+}
+PROMPT_TEMPLATE_TOKENS = 700 # 大纲Prompt模板本身的大致开销
+SETTING_SUMMARY_MODEL = 'models/gemini-2.5-flash' # 压缩超长角色设定使用的轻量模型
+SETTING_SUMMARY_CACHE_SIZE = 512
+# google-generativeai 不支持设置思考预算，而 gemini-2.5-flash 的思考 token 计入输出上限，这里为其预留空间
+SETTING_SUMMARY_THINKING_TOKENS = 4096
+SETTING_SUMMARY_TARGET_STEP = 50 # 摘要目标长度按此粒度向下取整，使不同长度的核心梗也能命中同一缓存
+MIN_SETTING_SUMMARY_TOKENS = 100 # 角色设定至少保留的长度，低于此值视为输入无法容纳
+CHARACTER_ANALYSIS_MAX_TOKENS = 300 # 注入大纲Prompt的单条角色分析上限，使用角色档案时从输入预算中预留
+
+
 # --- 数据库与模型定义 ---
 db = SQLAlchemy(app)
 
+# 统计每个请求在数据库上花费的时间，供慢请求日志使用
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    add_request_timing('db', time.perf_counter() - conn.info['query_start_times'].pop())
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_cursor_error(exception_context):
+    start_times = exception_context.connection.info.get('query_start_times') if exception_context.connection else None
+    if start_times:
+        add_request_timing('db', time.perf_counter() - start_times.pop())
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
@@ -60,14 +270,38 @@ class User(db.Model):
     is_verified = db.Column(db.Boolean, nullable=False, default=False)
     subscription_tier = db.Column(db.String(50), nullable=True, default='free')
 
+class Character(db.Model):
+    __tablename__ = 'character_profile' # 避免与 Postgres 的 character 类型名冲突
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    name = db.Column(db.String(120), nullable=False)
+    setting = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+class CharacterAnalysis(db.Model):
+    # 每个 (角色档案, 语言) 只生成一次性格分析；setting_hash 用于在设定被修改后使缓存失效
+    id = db.Column(db.Integer, primary_key=True)
+    character_id = db.Column(db.Integer, db.ForeignKey('character_profile.id'), nullable=False)
+    language = db.Column(db.String(10), nullable=False)
+    setting_hash = db.Column(db.String(64), nullable=False)
+    analysis = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    __table_args__ = (db.UniqueConstraint('character_id', 'language'),)
+
 class Prompt(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    # 使用角色档案生成时只记录档案ID，设定原文为空表示与档案当前文本一致；
+    # 档案被修改或删除前，会把旧文本快照写回这些记录（见 snapshot_profile_setting）
+    character1_id = db.Column(db.Integer, db.ForeignKey('character_profile.id'), nullable=True, index=True)
+    character2_id = db.Column(db.Integer, db.ForeignKey('character_profile.id'), nullable=True, index=True)
     character1_setting = db.Column(db.Text)
     character2_setting = db.Column(db.Text)
     core_prompt = db.Column(db.Text, nullable=False)
     generated_outline = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True) # 软删除标记，由后台清理任务物理删除
 
 class StoryOutline(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -77,9 +311,53 @@ class StoryOutline(db.Model):
     core_prompt = db.Column(db.Text, nullable=True)
     generated_outline = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True) # 软删除标记，由后台清理任务物理删除
+
+# create_all 不会修改已存在的表，这里为旧表补上后续版本新增的可空列及其索引
+SCHEMA_ADDED_COLUMNS = [
+    ('prompt', 'character1_id', 'INTEGER REFERENCES character_profile(id)'),
+    ('prompt', 'character2_id', 'INTEGER REFERENCES character_profile(id)'),
+    ('prompt', 'deleted_at', 'TIMESTAMP'),
+    ('story_outline', 'deleted_at', 'TIMESTAMP'),
+]
+# 索引名与模型中 index=True 时 SQLAlchemy 生成的名称一致（ix_<表名>_<列名>）
+SCHEMA_ADDED_INDEXES = [
+    ('prompt', 'character1_id'),
+    ('prompt', 'character2_id'),
+    ('prompt', 'deleted_at'),
+    ('story_outline', 'deleted_at'),
+]
+
+def apply_schema_change(statement, is_applied):
+    """
+    执行一条结构变更并单独提交。多个实例同时启动时可能都判断需要变更，
+    后执行的一方会因列/索引已存在而报错：此时回滚并确认变更已由其他实例完成即可。
+    """
+    try:
+        db.session.execute(sa_text(statement))
+        db.session.commit()
+    except DBAPIError:
+        db.session.rollback()
+        if not is_applied():
+            raise
+
+def ensure_schema_updates():
+    # Postgres 支持 ADD COLUMN IF NOT EXISTS；其他数据库（如本地 SQLite）依赖 apply_schema_change 的容错
+    if_not_exists = 'IF NOT EXISTS ' if db.engine.dialect.name == 'postgresql' else ''
+    for table, column, ddl in SCHEMA_ADDED_COLUMNS:
+        def column_exists(table=table, column=column):
+            return column in {c['name'] for c in sa_inspect(db.engine).get_columns(table)}
+        if not column_exists():
+            apply_schema_change(f'ALTER TABLE {table} ADD COLUMN {if_not_exists}{column} {ddl}', column_exists)
+            logger.info("数据库结构更新：已为 %s 表添加 %s 列。", table, column)
+    for table, column in SCHEMA_ADDED_INDEXES:
+        def index_exists(table=table, column=column):
+            return f'ix_{table}_{column}' in {i['name'] for i in sa_inspect(db.engine).get_indexes(table)}
+        apply_schema_change(f'CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})', index_exists)
 
 with app.app_context():
     db.create_all()
+    ensure_schema_updates()
 
 
 # --- API 密钥配置 ---
@@ -87,11 +365,11 @@ GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
 try:
     if GEMINI_API_KEY:
         genai.configure(api_key=GEMINI_API_KEY)
-        print("✅ Gemini API 密钥配置成功！")
+        logger.info("Gemini API 密钥配置成功！")
     else:
-        print("⚠️ 警告：GOOGLE_API_KEY 环境变量未设置。AI生成功能将不可用。")
-except Exception as e:
-    print(f"❌ Gemini API 密钥配置失败: {e}")
+        logger.warning("GOOGLE_API_KEY 环境变量未设置。AI生成功能将不可用。")
+except Exception:
+    logger.exception("Gemini API 密钥配置失败")
 
 
 # --- 2. 辅助函数与装饰器 ---
@@ -142,9 +420,9 @@ def send_verification_email(user_email, token, language='en'):
     configuration.api_key['api-key'] = os.environ.get('BREVO_API_KEY')
 
     if not configuration.api_key['api-key']:
-        print("!!! 邮件服务未配置：BREVO_API_KEY 环境变量未设置。邮件功能将不可用。")
+        logger.warning("邮件服务未配置：BREVO_API_KEY 环境变量未设置。邮件功能将不可用。")
         # 在开发环境中，仍然打印链接以便测试
-        print(f"!!! 为 {user_email} 生成的验证链接 (仅供测试): {verification_url}")
+        logger.info("为 %s 生成的验证链接 (仅供测试): %s", user_email, verification_url)
         return False, token # Return token for testing
 
     api_instance = sib_api_v3_sdk.TransactionalEmailsApi(sib_api_v3_sdk.ApiClient(configuration))
@@ -160,10 +438,10 @@ def send_verification_email(user_email, token, language='en'):
     # 发送邮件
     try:
         api_response = api_instance.send_transac_email(send_smtp_email)
-        print(f"邮件已发送至 {user_email}。 Brevo响应: {api_response})")
+        logger.info("邮件已发送至 %s。 Brevo响应: %s", user_email, api_response)
         return True, "Verification email sent."
     except ApiException as e:
-        print(f"!!! 通过Brevo发送邮件失败: {e} !!!")
+        logger.error("通过Brevo发送邮件失败: %s", e, extra={'error_class': type(e).__name__})
         return False, str(e)
 
 def token_required(f):
@@ -186,7 +464,8 @@ def token_required(f):
 
         # Handle real, logged-in users with a JWT
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
+            with timed('auth'): # 查询用户的耗时计入 db，这里只统计令牌校验
+                data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
             current_user = User.query.get(data['user_id'])
             if not current_user:
                 return make_error_response('user_not_found', '认证令牌无效，找不到用户', 401)
@@ -209,9 +488,164 @@ def admin_token_required(f):
 
 
 # --- 3. AI 核心功能 ---
-def get_ai_outline(char1, char2, plot_prompt, language):
-    language_instructions = {'en': 'in English', 'zh-CN': 'in Simplified Chinese (简体中文)', 'zh-TW': 'in Traditional Chinese (繁體中文)'}
-    output_language_instruction = language_instructions.get(language, 'in English')
+LANGUAGE_INSTRUCTIONS = {'en': 'in English', 'zh-CN': 'in Simplified Chinese (简体中文)', 'zh-TW': 'in Traditional Chinese (繁體中文)'}
+SAFETY_SETTINGS = [{"category": c, "threshold": "BLOCK_NONE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]]
+_CJK_RE = re.compile(r'[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_setting_summary_cache = OrderedDict()
+_setting_summary_cache_lock = threading.Lock()
+
+def estimate_tokens(text):
+    """本地估算 token 数：中日文字符约 1 token/字，其余约 4 字符/token。"""
+    if not text:
+        return 0
+    cjk_count = len(_CJK_RE.findall(text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
+
+def truncate_to_tokens(text, max_tokens):
+    """按估算的 token 数截断文本，保留开头部分。"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    budget = (max_tokens - 1) * 4 # 以 1/4 token 为单位计数，预留省略号
+    for index, char in enumerate(text):
+        budget -= 4 if _CJK_RE.match(char) else 1
+        if budget < 0:
+            return text[:index].rstrip() + "…"
+    return text
+
+def hit_output_token_limit(response):
+    """模型是否因达到 max_output_tokens 而停止（此时回复为空或被截断）。"""
+    candidates = getattr(response, 'candidates', None)
+    return bool(candidates) and getattr(candidates[0].finish_reason, 'name', None) == 'MAX_TOKENS'
+
+def get_token_budget(current_user):
+    if getattr(current_user, 'is_guest', False):
+        return TOKEN_BUDGETS['guest']
+    tier = getattr(current_user, 'subscription_tier', None) or 'free'
+    return TOKEN_BUDGETS.get(tier, TOKEN_BUDGETS['free'])
+
+def summarize_character_setting(setting, max_tokens):
+    """
+    将超长角色设定压缩到 max_tokens 以内，成功的摘要按设定原文缓存。
+    模型不可用、调用失败或摘要被截断时退化为截断原文，且不写入缓存，下次请求会重新尝试摘要。
+    """
+    cache_key = (hashlib.sha256(setting.encode('utf-8')).hexdigest(), max_tokens)
+    with _setting_summary_cache_lock:
+        if cache_key in _setting_summary_cache:
+            _setting_summary_cache.move_to_end(cache_key)
+            return _setting_summary_cache[cache_key]
+
+    summary = None
+    if GEMINI_API_KEY:
+        prompt = f"""Condense the following character profile into a dense summary of at most {max_tokens} tokens.
+Keep the character's name, personality, history, motivations and relationships. Keep the original language.
+Output only the summary, with no preamble.
+
+{setting}"""
+        try:
+            model = genai.GenerativeModel(SETTING_SUMMARY_MODEL)
+            with timed('model'):
+                response = model.generate_content(prompt, generation_config={
+                    'max_output_tokens': max_tokens * 2 + SETTING_SUMMARY_THINKING_TOKENS})
+            if hit_output_token_limit(response):
+                logger.warning("角色设定摘要达到输出上限，退化为截断")
+            elif response.parts:
+                summary = response.text.strip()
+        except Exception as e:
+            logger.warning("角色设定摘要失败，退化为截断: %s", e)
+
+    if not summary:
+        return truncate_to_tokens(setting, max_tokens)
+
+    summary = truncate_to_tokens(summary, max_tokens)
+    with _setting_summary_cache_lock:
+        _setting_summary_cache[cache_key] = summary
+        if len(_setting_summary_cache) > SETTING_SUMMARY_CACHE_SIZE:
+            _setting_summary_cache.popitem(last=False)
+    return summary
+
+def apply_token_budget(char1, char2, plot_prompt, budget, reserved_tokens=0):
+    """
+    在调用模型之前执行 token 预算检查。所有硬上限都先于摘要检查，超限请求不会产生任何模型开销。
+    reserved_tokens 为稍后还会加入Prompt的内容（如缓存的角色分析）预留的长度。
+    返回 ((char1, char2), None)，或在超出硬上限时返回 (None, (error_type, message))。
+    """
+    prompt_tokens = estimate_tokens(plot_prompt)
+    if prompt_tokens > budget['max_prompt_tokens']:
+        return None, ('input_too_large', f"核心梗过长，请控制在约 {budget['max_prompt_tokens']} token 以内。")
+
+    settings = (char1, char2)
+    setting_tokens = [estimate_tokens(setting) for setting in settings]
+    if max(setting_tokens) > budget['max_raw_setting_tokens']:
+        return None, ('input_too_large', f"角色设定过长，请控制在约 {budget['max_raw_setting_tokens']} token 以内。")
+
+    # 扣除模板和核心梗后剩余的输入预算，由短到长依次分给两个设定：
+    # 短设定按原长计入，超长设定平分剩余部分（且不超过 max_setting_tokens）作为摘要目标
+    remaining_tokens = budget['max_input_tokens'] - PROMPT_TEMPLATE_TOKENS - prompt_tokens - reserved_tokens
+    targets = [0] * len(settings)
+    for position, index in enumerate(sorted(range(len(settings)), key=lambda i: setting_tokens[i])):
+        share = remaining_tokens // (len(settings) - position)
+        targets[index] = min(setting_tokens[index], budget['max_setting_tokens'], share)
+        remaining_tokens -= targets[index]
+
+    summary_targets = [target // SETTING_SUMMARY_TARGET_STEP * SETTING_SUMMARY_TARGET_STEP if tokens > target else None
+                       for tokens, target in zip(setting_tokens, targets)]
+    if any(target is not None and target < MIN_SETTING_SUMMARY_TOKENS for target in summary_targets):
+        return None, ('input_too_large', f"输入内容总长度超出限制（约 {budget['max_input_tokens']} token）。")
+
+    compacted = tuple(setting if target is None else summarize_character_setting(setting, target)
+                      for setting, target in zip(settings, summary_targets))
+    return compacted, None
+
+def get_character_analysis(character, setting, language, max_output_tokens):
+    """
+    返回角色档案在指定语言下的性格分析，格式为 "角色名, 分析内容"。
+    同一 (档案, 语言) 只调用一次模型，结果存入 CharacterAnalysis；档案设定修改后自动重新生成。
+    setting 为经过 token 预算处理后的设定文本，安全设置与输出上限与大纲生成一致。返回 (analysis, error_info)。
+    """
+    setting_hash = hashlib.sha256(character.setting.encode('utf-8')).hexdigest()
+    cached = CharacterAnalysis.query.filter_by(character_id=character.id, language=language).first()
+    if cached and cached.setting_hash == setting_hash:
+        return truncate_to_tokens(cached.analysis, CHARACTER_ANALYSIS_MAX_TOKENS), None
+
+    output_language_instruction = LANGUAGE_INSTRUCTIONS.get(language, 'in English')
+    prompt = f"""
+You are a master of literary analysis. Analyze the following character **{output_language_instruction}**.
+Identify the character's name from the input, then write ONE paragraph of at most {CHARACTER_ANALYSIS_MAX_TOKENS * 2 // 3} words that begins with the character's name followed by a comma and the analysis text.
+Cover personality, history, motivations and how the character typically acts and reacts.
+Do not add any preamble, headings or markdown.
+
+**Character:** {setting}
+"""
+    try:
+        model = genai.GenerativeModel('models/gemini-2.5-pro')
+        with timed('model'):
+            response = model.generate_content(prompt, safety_settings=SAFETY_SETTINGS,
+                                              generation_config={'max_output_tokens': max_output_tokens})
+        if hit_output_token_limit(response):
+            return None, {"error": "生成内容超出长度上限", "reason": "角色分析生成未完成，本次不扣除点数，请精简角色设定后重试。"}
+        if not response.parts:
+            return None, {"error": "内容被安全系统拦截", "reason": "角色分析生成失败，请尝试修改角色设定。"}
+        analysis = truncate_to_tokens(response.text.strip(), CHARACTER_ANALYSIS_MAX_TOKENS)
+    except Exception as e:
+        logger.exception("角色分析 AI 调用失败")
+        return None, {"error": "AI 服务调用时发生内部错误", "reason": str(e)}
+
+    try:
+        if cached:
+            cached.analysis = analysis
+            cached.setting_hash = setting_hash
+        else:
+            db.session.add(CharacterAnalysis(character_id=character.id, language=language,
+                                             setting_hash=setting_hash, analysis=analysis))
+        db.session.commit()
+    except IntegrityError:
+        # 并发请求已写入同一 (档案, 语言) 的分析，直接使用本次结果即可
+        db.session.rollback()
+    return analysis, None
+
+def get_ai_outline(char1, char2, plot_prompt, language, max_output_tokens=None, character_analyses=None):
+    """character_analyses 为 (角色1分析, 角色2分析) 时，模型只需生成情节大纲，分析部分直接拼接缓存结果。"""
+    output_language_instruction = LANGUAGE_INSTRUCTIONS.get(language, 'in English')
 
     section_titles = {
         'en': {
@@ -253,32 +687,54 @@ def get_ai_outline(char1, char2, plot_prompt, language):
     }
     current_titles = section_titles.get(language, section_titles['en']) # Fallback to English
 
+    analysis_header = ""
+    if character_analyses:
+        analysis_header = f"""### {current_titles['char_analysis']}
+
+* {current_titles['char1_label']}: {character_analyses[0]}
+* {current_titles['char2_label']}: {character_analyses[1]}
+
+"""
+        first_section = "plot outline"
+        task_description = f"""Generate a detailed plot outline **{output_language_instruction}** based on the following information. The character analysis has already been written and is given below; treat it as canon and do NOT repeat it in your output.
+
+**Character 1:** {char1}
+**Character 2:** {char2}
+**Character 1 Analysis:** {character_analyses[0]}
+**Character 2 Analysis:** {character_analyses[1]}
+**Core Plot Prompt:** {plot_prompt}"""
+        analysis_format = ""
+    else:
+        first_section = "analysis"
+        task_description = f"""Generate a character analysis and a detailed plot outline **{output_language_instruction}** based on the following information.
+
+**Character 1:** {char1}
+**Character 2:** {char2}
+**Core Plot Prompt:** {plot_prompt}"""
+        analysis_format = f"""### {current_titles['char_analysis']}
+
+* {current_titles['char1_label']}: [Identify Character 1's name from the input. Then, begin your analysis with the character's name followed by a comma and the analysis text.]
+* {current_titles['char2_label']}: [Identify Character 2's name from the input. Then, begin your analysis with the character's name followed by a comma and the analysis text.]
+
+"""
+
     prompt = f"""
 # ROLE & GOAL
 You are a character-driven storyteller and a master of literary analysis. Your highest priority is maintaining character integrity. Your goal is to generate a plot outline that feels like it was written by someone who has loved these characters for years, and you MUST generate it in the requested language.
 
 # CORE DIRECTIVES - YOU MUST FOLLOW THESE RULES
 1. **NO OOC (Out Of Character) ACTIONS**: This is the most critical rule. Before writing, deeply analyze the provided character descriptions. Every action, decision, and reaction in the plot MUST be a believable extension of their established personality, history, and motivations.
-2. **NO CONVERSATIONAL PREAMBLE**: Do not start your response with any conversational text like "好的，我将..." or "Okay, I will...". Begin your response directly with the requested analysis.
+2. **NO CONVERSATIONAL PREAMBLE**: Do not start your response with any conversational text like "好的，我将..." or "Okay, I will...". Begin your response directly with the requested {first_section}.
 3. **USE MARKDOWN FOR STRUCTURE**: You must use markdown for formatting as specified in the OUTPUT FORMAT section.
 4. **STRICTLY ADHERE TO LANGUAGE**: Your entire output, including section titles and content, MUST be in the language specified by '{output_language_instruction}'.
 
 # TASK
-Generate a character analysis and a detailed plot outline **{output_language_instruction}** based on the following information.
-
-**Character 1:** {char1}
-**Character 2:** {char2}
-**Core Plot Prompt:** {plot_prompt}
+{task_description}
 
 # OUTPUT FORMAT
 Your output MUST be in markdown format and structured EXACTLY as follows. Ensure there is a blank line after each heading.
 
-### {current_titles['char_analysis']}
-
-* {current_titles['char1_label']}: [Identify Character 1's name from the input. Then, begin your analysis with the character's name followed by a comma and the analysis text.]
-* {current_titles['char2_label']}: [Identify Character 2's name from the input. Then, begin your analysis with the character's name followed by a comma and the analysis text.]
-
-### {current_titles['plot_outline']}
+{analysis_format}### {current_titles['plot_outline']}
 
 **1. {current_titles['opening']}:** [How the story begins]
 
@@ -295,8 +751,13 @@ Your output MUST be in markdown format and structured EXACTLY as follows. Ensure
     try:
         # ✅ --- 恢复使用核心模型 ---
         model = genai.GenerativeModel('models/gemini-2.5-pro')
-        safety_settings = [{"category": c, "threshold": "BLOCK_NONE"} for c in ["HARM_CATEGORY_HARASSMENT", "HARM_CATEGORY_HATE_SPEECH", "HARM_CATEGORY_SEXUALLY_EXPLICIT", "HARM_CATEGORY_DANGEROUS_CONTENT"]]
-        response = model.generate_content(prompt, safety_settings=safety_settings)
+        generation_config = {'max_output_tokens': max_output_tokens} if max_output_tokens else None
+        with timed('model'):
+            response = model.generate_content(prompt, safety_settings=SAFETY_SETTINGS, generation_config=generation_config)
+
+        # 被截断的大纲不返回、不保存，调用方也不会扣除点数
+        if hit_output_token_limit(response):
+            return None, {"error": "生成内容超出长度上限", "reason": "大纲生成未完成，本次不扣除点数，请精简设定或核心梗后重试。"}
 
         if not response.parts:
             block_reason_detail = "Unknown"
@@ -304,9 +765,9 @@ Your output MUST be in markdown format and structured EXACTLY as follows. Ensure
                 block_reason_detail = response.prompt_feedback.block_reason.name
             return None, {"error": "内容被安全系统拦截", "reason": f"原因: {block_reason_detail}. 请尝试修改Prompt。"}
 
-        return response.text, None
+        return analysis_header + response.text, None
     except Exception as e:
-        print(f"!!! AI 调用失败: {e} !!!"); print(traceback.format_exc())
+        logger.exception("AI 调用失败")
         return None, {"error": "AI 服务调用时发生内部错误", "reason": str(e)}
 
 
@@ -357,8 +818,7 @@ def register():
 
     except Exception as e:
         db.session.rollback()
-        print(f"!!! /api/register 发生严重错误: {e} !!!")
-        print(traceback.format_exc())
+        logger.exception("/api/register 发生严重错误")
         return make_error_response("registration_failed", f"注册过程中发生内部错误，操作已回滚。错误详情: {e}", 500)
 
 
@@ -486,9 +946,8 @@ def resend_verification_email():
             return jsonify({'message': '验证邮件已重新发送，请检查您的邮箱。'}), 200
         else:
             return make_error_response('email_send_failed', f'重新发送验证邮件失败: {detail}', 500)
-    except Exception as e:
-        print(f"!!! /api/resend-verification-email 发生错误: {e} !!!")
-        print(traceback.format_exc())
+    except Exception:
+        logger.exception("/api/resend-verification-email 发生错误")
         return make_error_response('internal_server_error', '重新发送验证邮件时发生内部错误。', 500)
 
 @app.route('/api/generate', methods=['POST'])
@@ -510,11 +969,48 @@ def generate_plot_outline_for_user(current_user):
         char2 = data.get('character2')
         plot_prompt = data.get('plot_prompt')
         language = data.get('language', 'en') # 默认为英文
+        char1_id = data.get('character1_id')
+        char2_id = data.get('character2_id')
+
+        # 使用已保存的角色档案时，设定文本来自档案，性格分析走缓存
+        profiles = None
+        if char1_id is not None or char2_id is not None:
+            if is_guest:
+                return make_error_response("unauthorized", "游客无法使用角色档案。", 403)
+            if char1_id is None or char2_id is None:
+                return make_error_response('missing_input', '使用角色档案时必须同时指定 character1_id 和 character2_id。', 400)
+            profiles = (Character.query.filter_by(id=char1_id, user_id=current_user.id).first(),
+                        Character.query.filter_by(id=char2_id, user_id=current_user.id).first())
+            if not all(profiles):
+                return make_error_response("not_found", "角色档案未找到。", 404)
+            char1, char2 = profiles[0].setting, profiles[1].setting
 
         if not all([char1, char2, plot_prompt]):
             return make_error_response('missing_input', '角色1, 角色2, 和核心梗不能为空。', 400)
-
-        generated_text, error_info = get_ai_outline(char1, char2, plot_prompt, language)
+        if not all(isinstance(v, str) for v in (char1, char2, plot_prompt)):
+            return make_error_response('invalid_input', '角色1, 角色2, 和核心梗必须是文本。', 400)
+
+        # 先做 token 预算检查，超限请求在任何模型开销之前被拒绝
+        budget = get_token_budget(current_user)
+        # 使用角色档案时，两条缓存的角色分析也会加入Prompt，需要预留其长度
+        reserved_tokens = 2 * CHARACTER_ANALYSIS_MAX_TOKENS if profiles else 0
+        budgeted_settings, budget_error = apply_token_budget(char1, char2, plot_prompt, budget, reserved_tokens)
+        if budget_error:
+            return make_error_response(budget_error[0], budget_error[1], 413)
+        prompt_char1, prompt_char2 = budgeted_settings
+
+        character_analyses = None
+        if profiles:
+            character_analyses = []
+            for profile, setting in zip(profiles, budgeted_settings):
+                analysis, error_info = get_character_analysis(profile, setting, language, budget['max_output_tokens'])
+                if error_info:
+                    return jsonify(error_info), 500
+                character_analyses.append(analysis)
+
+        generated_text, error_info = get_ai_outline(prompt_char1, prompt_char2, plot_prompt, language,
+                                                    max_output_tokens=budget['max_output_tokens'],
+                                                    character_analyses=character_analyses)
 
         if error_info:
             return jsonify(error_info), 500
@@ -522,9 +1018,19 @@ def generate_plot_outline_for_user(current_user):
         remaining_credits = None
         if not is_guest:
             current_user.credits -= 1
+            setting_snapshots = (char1, char2)
+            if profiles:
+                # 生成期间档案可能已被修改：锁定档案行并比对当前文本，仅在一致时省略快照
+                current_settings = dict(db.session.query(Character.id, Character.setting)
+                                        .filter(Character.id.in_([profile.id for profile in profiles]))
+                                        .with_for_update())
+                setting_snapshots = tuple(None if current_settings.get(profile.id) == setting else setting
+                                          for profile, setting in zip(profiles, (char1, char2)))
             new_prompt_record = Prompt(user_id=current_user.id,
-                                       character1_setting=char1,
-                                       character2_setting=char2,
+                                       character1_id=profiles[0].id if profiles else None,
+                                       character2_id=profiles[1].id if profiles else None,
+                                       character1_setting=setting_snapshots[0],
+                                       character2_setting=setting_snapshots[1],
                                        core_prompt=plot_prompt,
                                        generated_outline=generated_text)
             db.session.add(new_prompt_record)
@@ -535,11 +1041,12 @@ def generate_plot_outline_for_user(current_user):
         if remaining_credits is not None:
             response_data["remaining_credits"] = remaining_credits
 
-        return jsonify(response_data)
+        with timed('serialize'):
+            return jsonify(response_data)
 
-    except Exception as e:
+    except Exception:
         db.session.rollback() # 确保在异常发生时回滚数据库事务
-        print(f"!!! /api/generate 发生未知错误: {e} !!!"); print(traceback.format_exc())
+        logger.exception("/api/generate 发生未知错误")
         return make_error_response("internal_server_error", "处理您的请求时发生未知错误。", 500)
 
 
@@ -577,13 +1084,41 @@ def save_outline(current_user):
             }
         }), 201
 
-    except Exception as e:
+    except Exception:
         db.session.rollback()
-        print(f"!!! /api/outlines POST 发生错误: {e} !!!")
-        print(traceback.format_exc())
+        logger.exception("/api/outlines POST 发生错误")
         return make_error_response("internal_server_error", "保存大纲时发生内部错误。", 500)
 
 
+def prompt_to_history_item(p, character_settings):
+    # 通过角色档案生成且档案未被修改过的记录只存了档案ID，这里还原设定文本
+    return {
+        'type': 'generated',
+        'id': p.id,
+        'character1': p.character1_setting if p.character1_setting is not None else character_settings.get(p.character1_id),
+        'character2': p.character2_setting if p.character2_setting is not None else character_settings.get(p.character2_id),
+        'character1_id': p.character1_id,
+        'character2_id': p.character2_id,
+        'core_prompt': p.core_prompt,
+        'generated_outline': p.generated_outline,
+        'created_at': p.created_at
+    }
+
+def outline_to_history_item(o):
+    return {
+        'type': 'saved',
+        'id': o.id,
+        'character1': o.character1,
+        'character2': o.character2,
+        'core_prompt': o.core_prompt,
+        'generated_outline': o.generated_outline,
+        'created_at': o.created_at
+    }
+
+def get_character_settings(user_id):
+    return {c.id: c.setting for c in Character.query.filter_by(user_id=user_id).all()}
+
+
 @app.route('/api/history', methods=['GET'])
 @token_required
 def get_history(current_user):
@@ -591,32 +1126,17 @@ def get_history(current_user):
         return jsonify([])  # 游客没有历史记录
 
     history_items = []
+    character_settings = get_character_settings(current_user.id)
 
     # 获取AI生成的历史记录
-    prompts = Prompt.query.filter_by(user_id=current_user.id).all()
+    prompts = Prompt.query.filter_by(user_id=current_user.id, deleted_at=None).all()
     for p in prompts:
-        history_items.append({
-            'type': 'generated',
-            'id': p.id,
-            'character1': p.character1_setting,
-            'character2': p.character2_setting,
-            'core_prompt': p.core_prompt,
-            'generated_outline': p.generated_outline,
-            'created_at': p.created_at
-        })
+        history_items.append(prompt_to_history_item(p, character_settings))
 
     # 获取用户手动保存的大纲
-    outlines = StoryOutline.query.filter_by(user_id=current_user.id).all()
+    outlines = StoryOutline.query.filter_by(user_id=current_user.id, deleted_at=None).all()
     for o in outlines:
-        history_items.append({
-            'type': 'saved',
-            'id': o.id,
-            'character1': o.character1,
-            'character2': o.character2,
-            'core_prompt': o.core_prompt,
-            'generated_outline': o.generated_outline,
-            'created_at': o.created_at
-        })
+        history_items.append(outline_to_history_item(o))
 
     # 按创建时间降序排序
     history_items.sort(key=lambda x: x['created_at'], reverse=True)
@@ -625,7 +1145,119 @@ def get_history(current_user):
     for item in history_items:
         item['created_at'] = item['created_at'].isoformat() + "Z"
 
-    return jsonify(history_items)
+    with timed('serialize'):
+        return jsonify(history_items)
+
+
+# --- 历史记录导出（流式） ---
+EXPORT_YIELD_PER = 200 # 每次从服务端游标取出的行数
+EXPORT_CHUNK_SIZE = 64 * 1024 # 攒够这么多字节再向客户端写出一次
+
+def iter_history_export_items(user_id):
+    """通过服务端游标逐行读取两张表，内存占用与历史记录总量无关。"""
+    character_settings = get_character_settings(user_id)
+    prompts = Prompt.query.filter_by(user_id=user_id, deleted_at=None).order_by(Prompt.id).yield_per(EXPORT_YIELD_PER)
+    for p in prompts:
+        yield prompt_to_history_item(p, character_settings)
+    outlines = StoryOutline.query.filter_by(user_id=user_id, deleted_at=None).order_by(StoryOutline.id).yield_per(EXPORT_YIELD_PER)
+    for o in outlines:
+        yield outline_to_history_item(o)
+
+def history_item_to_markdown(item):
+    lines = [f"# {item['type']} #{item['id']}", "", f"- created_at: {item['created_at'].isoformat()}Z"]
+    for key in ('character1', 'character2', 'core_prompt'):
+        if item[key]:
+            lines.append(f"- {key}: {item[key]}")
+    lines += ["", item['generated_outline'] or "", ""]
+    return "\n".join(lines)
+
+class _ChunkBuffer:
+    """供 zipfile 写入的只追加缓冲区；不支持 tell/seek，zipfile 会自动切换为流式写法。"""
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks, self.size = [], 0
+        return data
+
+def stream_history_ndjson(items):
+    buffer = _ChunkBuffer()
+    for item in items:
+        item['created_at'] = item['created_at'].isoformat() + "Z"
+        buffer.write((json.dumps(item, ensure_ascii=False) + "\n").encode('utf-8'))
+        if buffer.size >= EXPORT_CHUNK_SIZE:
+            yield buffer.drain()
+    yield buffer.drain()
+
+def stream_history_zip(items):
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for item in items:
+            with archive.open(f"{item['type']}/{item['id']}.md", mode='w') as entry:
+                entry.write(history_item_to_markdown(item).encode('utf-8'))
+            if buffer.size >= EXPORT_CHUNK_SIZE:
+                yield buffer.drain()
+    yield buffer.drain() # 中央目录在 ZipFile 关闭时写入
+
+def timed_stream(chunks):
+    """把生成每个数据块的耗时（扣除其中已计入 db 的部分）累加到 serialize。"""
+    iterator = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        db_before = g.get('timings', {}).get('db', 0.0)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            db_seconds = g.get('timings', {}).get('db', 0.0) - db_before
+            add_request_timing('serialize', time.perf_counter() - start - db_seconds)
+        yield chunk
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits=31 输出 gzip 格式
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.route('/api/history/export', methods=['GET'])
+@limiter.limit("10 per hour", error_message="导出过于频繁，请稍后再试。")
+@token_required
+def export_history(current_user):
+    if getattr(current_user, 'is_guest', False):
+        return make_error_response("unauthorized", "游客没有可导出的历史记录。", 403)
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format == 'ndjson':
+        chunks = stream_history_ndjson(iter_history_export_items(current_user.id))
+        mimetype, filename = 'application/x-ndjson', 'plot-ark-history.ndjson'
+    elif export_format == 'zip':
+        chunks = stream_history_zip(iter_history_export_items(current_user.id))
+        mimetype, filename = 'application/zip', 'plot-ark-history.zip'
+    else:
+        return make_error_response('bad_request', 'format 只能是 ndjson 或 zip。', 400)
+
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"', 'X-Accel-Buffering': 'no'}
+    # ZIP 本身已压缩，只对 NDJSON 按客户端的 Accept-Encoding 启用 gzip
+    if export_format == 'ndjson' and request.accept_encodings['gzip'] > 0:
+        chunks = gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+
+    return Response(stream_with_context(timed_stream(chunks)), mimetype=mimetype, headers=headers)
 
 
 @app.route('/api/history/<int:prompt_id>', methods=['DELETE'])
@@ -637,7 +1269,7 @@ def delete_history_item(current_user, prompt_id):
 
     prompt_to_delete = Prompt.query.get(prompt_id)
 
-    if not prompt_to_delete:
+    if not prompt_to_delete or prompt_to_delete.deleted_at is not None:
         return make_error_response("not_found", "记录未找到。", 404)
 
     if prompt_to_delete.user_id != current_user.id:
@@ -648,6 +1280,233 @@ def delete_history_item(current_user, prompt_id):
     return jsonify({"message": "记录已成功删除。"}), 200
 
 
+# --- 批量删除与软删除清理 ---
+BULK_DELETE_MAX_IDS = 1000 # 单次批量删除的最大条数（两张表合计）
+PURGE_BATCH_SIZE = 200 # 后台清理每批物理删除的行数，避免长时间锁表
+PURGE_BATCH_PAUSE_SECONDS = 0.2 # 每批之间的间隔，给在线请求让出数据库
+PURGE_ADMIN_MAX_BATCHES = 5 # 管理员接口每张表每次最多清理的批数，避免长时间占用请求线程
+PURGE_INTERVAL_SECONDS = int(os.environ.get('PURGE_INTERVAL_SECONDS', 300))
+# 后台清理线程只在显式开启时随服务启动（见 Dockerfile），导入模块的脚本和测试不会启动它
+PURGE_WORKER_ENABLED = os.environ.get('PURGE_WORKER_ENABLED') == '1'
+_purge_worker_started = False
+
+def parse_id_list(value):
+    """解析请求中的ID列表，返回去重后的整数列表；格式不合法时返回 None。"""
+    if value is None:
+        return []
+    if not isinstance(value, list) or not all(isinstance(v, int) and not isinstance(v, bool) for v in value):
+        return None
+    return list(set(value))
+
+def purge_soft_deleted(model, batch_size=PURGE_BATCH_SIZE, max_batches=None):
+    """
+    分批物理删除已软删除的行，每批单独提交。max_batches 限制本次最多处理的批数。
+    返回 (删除的总行数, 是否可能还有未清理的行)。
+    """
+    purged = 0
+    batches = 0
+    while True:
+        ids = [row.id for row in db.session.query(model.id).filter(model.deleted_at.isnot(None)).limit(batch_size)]
+        if not ids:
+            return purged, False
+        purged += model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        batches += 1
+        if len(ids) < batch_size:
+            return purged, False
+        if max_batches is not None and batches >= max_batches:
+            return purged, True
+        time.sleep(PURGE_BATCH_PAUSE_SECONDS)
+
+def purge_all_soft_deleted(max_batches=None):
+    """返回 ({'generated': 行数, 'saved': 行数}, 是否还有未清理的行)。"""
+    generated, generated_remaining = purge_soft_deleted(Prompt, max_batches=max_batches)
+    saved, saved_remaining = purge_soft_deleted(StoryOutline, max_batches=max_batches)
+    return {'generated': generated, 'saved': saved}, generated_remaining or saved_remaining
+
+def run_purge_worker():
+    while True:
+        time.sleep(PURGE_INTERVAL_SECONDS)
+        with app.app_context():
+            try:
+                purged, _ = purge_all_soft_deleted()
+                if any(purged.values()):
+                    logger.info("后台清理：已物理删除软删除记录 %s", purged)
+            except Exception:
+                db.session.rollback()
+                logger.exception("后台清理软删除记录失败")
+            finally:
+                db.session.remove()
+
+def start_purge_worker():
+    # 注意：Cloud Run 在无请求时会限制 CPU，此线程只是尽力而为，可配合 /api/admin/purge_deleted 定时触发
+    global _purge_worker_started
+    if PURGE_INTERVAL_SECONDS > 0 and not _purge_worker_started:
+        _purge_worker_started = True
+        threading.Thread(target=run_purge_worker, name='soft-delete-purger', daemon=True).start()
+
+
+@app.route('/api/history/bulk-delete', methods=['POST'])
+@token_required
+def bulk_delete_history(current_user):
+    if getattr(current_user, 'is_guest', False):
+        return make_error_response("unauthorized", "游客无权删除记录。", 403)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return make_error_response('bad_request', '请求体必须是 JSON 对象。', 400)
+    generated_ids = parse_id_list(data.get('generated_ids'))
+    saved_ids = parse_id_list(data.get('saved_ids'))
+    mode = data.get('mode', 'soft')
+
+    if generated_ids is None or saved_ids is None:
+        return make_error_response('bad_request', 'generated_ids 和 saved_ids 必须是整数数组。', 400)
+    if not generated_ids and not saved_ids:
+        return make_error_response('missing_input', '请至少指定一条要删除的记录。', 400)
+    if len(generated_ids) + len(saved_ids) > BULK_DELETE_MAX_IDS:
+        return make_error_response('bad_request', f'单次最多删除 {BULK_DELETE_MAX_IDS} 条记录。', 400)
+    if mode not in ('soft', 'hard'):
+        return make_error_response('bad_request', 'mode 只能是 soft 或 hard。', 400)
+
+    try:
+        deleted = {}
+        for key, model, ids in (('generated', Prompt, generated_ids), ('saved', StoryOutline, saved_ids)):
+            if not ids:
+                deleted[key] = 0
+                continue
+            # 按集合一次性删除，user_id 条件保证只能删除自己的记录
+            query = model.query.filter(model.user_id == current_user.id, model.id.in_(ids))
+            if mode == 'soft':
+                deleted[key] = query.filter(model.deleted_at.is_(None)).update(
+                    {'deleted_at': datetime.datetime.utcnow()}, synchronize_session=False)
+            else:
+                deleted[key] = query.delete(synchronize_session=False)
+        db.session.commit()
+        return jsonify({"message": "记录已成功删除。", "mode": mode, "deleted": deleted}), 200
+    except Exception:
+        db.session.rollback()
+        logger.exception("/api/history/bulk-delete 发生错误")
+        return make_error_response("internal_server_error", "批量删除记录时发生内部错误。", 500)
+
+
+def snapshot_profile_setting(character):
+    """把档案当前的设定文本写入仍依赖它的历史记录，在修改或删除档案之前调用。"""
+    Prompt.query.filter(Prompt.character1_id == character.id, Prompt.character1_setting.is_(None)).update(
+        {'character1_setting': character.setting}, synchronize_session=False)
+    Prompt.query.filter(Prompt.character2_id == character.id, Prompt.character2_setting.is_(None)).update(
+        {'character2_setting': character.setting}, synchronize_session=False)
+
+def character_to_dict(character):
+    return {
+        'id': character.id,
+        'name': character.name,
+        'setting': character.setting,
+        'created_at': character.created_at.isoformat() + "Z",
+        'updated_at': character.updated_at.isoformat() + "Z" if character.updated_at else None,
+    }
+
+def validate_character_input(data, current_user):
+    """校验角色档案的 name/setting，返回 (name, setting, None) 或 (None, None, error_response)。"""
+    name = data.get('name')
+    setting = data.get('setting')
+    if not name or not setting:
+        return None, None, make_error_response('missing_input', '角色名和角色设定不能为空。', 400)
+    if not isinstance(name, str) or not isinstance(setting, str):
+        return None, None, make_error_response('invalid_input', '角色名和角色设定必须是文本。', 400)
+    if len(name) > 120:
+        return None, None, make_error_response('invalid_input', '角色名不能超过120个字符。', 400)
+    max_raw_setting_tokens = get_token_budget(current_user)['max_raw_setting_tokens']
+    if estimate_tokens(setting) > max_raw_setting_tokens:
+        return None, None, make_error_response('input_too_large', f"角色设定过长，请控制在约 {max_raw_setting_tokens} token 以内。", 413)
+    return name, setting, None
+
+
+@app.route('/api/characters', methods=['GET'])
+@token_required
+def list_characters(current_user):
+    if getattr(current_user, 'is_guest', False):
+        return jsonify([])
+
+    characters = Character.query.filter_by(user_id=current_user.id).order_by(Character.updated_at.desc()).all()
+    with timed('serialize'):
+        return jsonify([character_to_dict(c) for c in characters])
+
+
+@app.route('/api/characters', methods=['POST'])
+@token_required
+def create_character(current_user):
+    if getattr(current_user, 'is_guest', False):
+        return make_error_response("unauthorized", "游客无法保存角色档案。", 403)
+
+    name, setting, error_response = validate_character_input(request.get_json() or {}, current_user)
+    if error_response:
+        return error_response
+
+    try:
+        character = Character(user_id=current_user.id, name=name, setting=setting)
+        db.session.add(character)
+        db.session.commit()
+        return jsonify({"message": "角色档案已保存。", "character": character_to_dict(character)}), 201
+    except Exception:
+        db.session.rollback()
+        logger.exception("/api/characters POST 发生错误")
+        return make_error_response("internal_server_error", "保存角色档案时发生内部错误。", 500)
+
+
+@app.route('/api/characters/<int:character_id>', methods=['PUT'])
+@token_required
+def update_character(current_user, character_id):
+    if getattr(current_user, 'is_guest', False):
+        return make_error_response("unauthorized", "游客无法修改角色档案。", 403)
+
+    name, setting, error_response = validate_character_input(request.get_json() or {}, current_user)
+    if error_response:
+        return error_response
+
+    # 锁定档案行，与 /api/generate 写入历史记录时的比对互斥
+    character = Character.query.filter_by(id=character_id, user_id=current_user.id).with_for_update().first()
+    if not character:
+        db.session.rollback()
+        return make_error_response("not_found", "角色档案未找到。", 404)
+
+    try:
+        if setting != character.setting:
+            snapshot_profile_setting(character) # 保证旧的历史记录仍显示生成时使用的文本
+        character.name = name
+        character.setting = setting # 设定变化后，缓存的分析会因 setting_hash 不匹配而重新生成
+        db.session.commit()
+        return jsonify({"message": "角色档案已更新。", "character": character_to_dict(character)})
+    except Exception:
+        db.session.rollback()
+        logger.exception("/api/characters PUT 发生错误")
+        return make_error_response("internal_server_error", "更新角色档案时发生内部错误。", 500)
+
+
+@app.route('/api/characters/<int:character_id>', methods=['DELETE'])
+@token_required
+def delete_character(current_user, character_id):
+    if getattr(current_user, 'is_guest', False):
+        return make_error_response("unauthorized", "游客无权删除角色档案。", 403)
+
+    character = Character.query.filter_by(id=character_id, user_id=current_user.id).first()
+    if not character:
+        return make_error_response("not_found", "角色档案未找到。", 404)
+
+    try:
+        # 引用该档案的历史记录改回存储设定原文，保证历史内容不丢失
+        snapshot_profile_setting(character)
+        Prompt.query.filter_by(character1_id=character.id).update({'character1_id': None}, synchronize_session=False)
+        Prompt.query.filter_by(character2_id=character.id).update({'character2_id': None}, synchronize_session=False)
+        CharacterAnalysis.query.filter_by(character_id=character.id).delete(synchronize_session=False)
+        db.session.delete(character)
+        db.session.commit()
+        return jsonify({"message": "角色档案已删除。"}), 200
+    except Exception:
+        db.session.rollback()
+        logger.exception("/api/characters DELETE 发生错误")
+        return make_error_response("internal_server_error", "删除角色档案时发生内部错误。", 500)
+
+
 @app.route('/api/admin/update_credits', methods=['POST'])
 @admin_token_required
 def admin_update_credits():
@@ -671,12 +1530,38 @@ def admin_update_credits():
     user.credits += credits_to_add
     db.session.commit()
 
-    print(f"管理员操作：为用户 {email} 增加了 {credits_to_add} 点数。新余额: {user.credits}")
+    logger.info("管理员操作：为用户 %s 增加了 %s 点数。新余额: %s", email, credits_to_add, user.credits)
     return jsonify({'message': '点数更新成功', 'email': user.email, 'new_credits_balance': user.credits})
 
 
+@app.route('/api/admin/purge_deleted', methods=['POST'])
+@admin_token_required
+def admin_purge_deleted():
+    try:
+        purged, remaining = purge_all_soft_deleted(max_batches=PURGE_ADMIN_MAX_BATCHES)
+    except Exception:
+        db.session.rollback()
+        logger.exception("/api/admin/purge_deleted 发生错误")
+        return make_error_response("internal_server_error", "清理软删除记录时发生内部错误。", 500)
+
+    logger.info("管理员操作：已物理删除软删除记录 %s", purged)
+    # remaining 为 true 时说明本次达到批数上限，调用方可再次调用继续清理
+    return jsonify({'message': '清理完成', 'purged': purged, 'remaining': remaining})
+
+
+@app.route('/api/admin/log_stats', methods=['GET'])
+@admin_token_required
+def admin_log_stats():
+    # 用于压测时评估日志量：入队、因队列满丢弃、被错误采样省略的条数
+    return jsonify({**LOG_STATS, 'queue_size': _log_queue.qsize()})
+
+
 # --- 5. 启动服务 ---
+if PURGE_WORKER_ENABLED: # gunicorn 通过导入模块启动服务，由环境变量显式开启
+    start_purge_worker()
+
 if __name__ == '__main__':
+    start_purge_worker()
     port = int(os.environ.get("PORT", 8080))
     # ✅ --- 修正拼写错误 ---
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# app.py 在导入时即连接数据库并建表，因此必须在任何测试导入它之前指向临时 SQLite 数据库。
+import os
+import sys
+import tempfile
+
+_db_fd, _db_path = tempfile.mkstemp(suffix='.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{_db_path}'
+os.environ.pop('GOOGLE_API_KEY', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import datetime # noqa: E402 以下导入必须在上面的环境变量设置之后
+
+import jwt # noqa: E402
+import pytest # noqa: E402
+
+import app as plot_ark # noqa: E402
+
+
+@pytest.fixture
+def client():
+    """空数据库 + 一个已验证用户，返回带该用户令牌的测试客户端。"""
+    plot_ark.limiter.enabled = False
+    with plot_ark.app.app_context():
+        plot_ark.db.drop_all()
+        plot_ark.db.create_all()
+        user = plot_ark.User(email='writer@example.com', password_hash='x', credits=10, is_verified=True)
+        plot_ark.db.session.add(user)
+        plot_ark.db.session.commit()
+        token = jwt.encode({'user_id': user.id, 'exp': datetime.datetime.utcnow() + datetime.timedelta(days=1)},
+                           plot_ark.app.config['SECRET_KEY'], algorithm="HS256")
+    test_client = plot_ark.app.test_client()
+    test_client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    return test_client
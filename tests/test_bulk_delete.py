@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# 批量删除：请求体不是 JSON 对象时返回 400，而不是 500。
+import pytest
+
+import app as plot_ark
+
+
+@pytest.mark.parametrize('body', [[1, 2], 'ids', None])
+def test_non_object_body_is_rejected_with_bad_request(client, body):
+    response = client.post('/api/history/bulk-delete', json=body)
+
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'bad_request'
+
+
+def test_soft_delete_hides_only_own_items(client):
+    with plot_ark.app.app_context():
+        other = plot_ark.User(email='other@example.com', password_hash='x')
+        plot_ark.db.session.add(other)
+        plot_ark.db.session.commit()
+        plot_ark.db.session.add_all([plot_ark.Prompt(user_id=1, core_prompt='mine', generated_outline='o'),
+                                     plot_ark.Prompt(user_id=other.id, core_prompt='theirs', generated_outline='o')])
+        plot_ark.db.session.commit()
+
+    response = client.post('/api/history/bulk-delete', json={'generated_ids': [1, 2]})
+
+    assert response.get_json()['deleted'] == {'generated': 1, 'saved': 0}
+    assert client.get('/api/history').get_json() == []
+    with plot_ark.app.app_context():
+        assert plot_ark.Prompt.query.get(2).deleted_at is None
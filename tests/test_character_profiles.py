@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# 角色档案与历史记录：修改档案后，旧的历史记录仍应显示生成时使用的设定文本。
+import json
+
+import pytest
+
+import app as plot_ark
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.parts = [text]
+        self.candidates = []
+        self.prompt_feedback = None
+
+
+class FakeModel:
+    analysis = "Alice, analysis."
+    outline_prompts = []
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def generate_content(self, prompt, **kwargs):
+        if 'ONE paragraph' in prompt:
+            return FakeResponse(self.analysis)
+        self.outline_prompts.append(prompt)
+        return FakeResponse("### Plot Outline\n\noutline")
+
+
+@pytest.fixture(autouse=True)
+def fake_model(monkeypatch):
+    monkeypatch.setattr(plot_ark.genai, 'GenerativeModel', FakeModel)
+    monkeypatch.setattr(FakeModel, 'outline_prompts', [])
+
+
+def create_profiles(client):
+    alice = client.post('/api/characters', json={'name': 'Alice', 'setting': 'Alice is brave'}).get_json()
+    bob = client.post('/api/characters', json={'name': 'Bob', 'setting': 'Bob is shy'}).get_json()
+    return alice['character']['id'], bob['character']['id']
+
+
+def generate(client, alice_id, bob_id):
+    response = client.post('/api/generate', json={'character1_id': alice_id, 'character2_id': bob_id,
+                                                  'plot_prompt': 'they meet'})
+    assert response.status_code == 200
+
+
+def test_history_keeps_setting_used_at_generation_after_profile_edit(client):
+    alice_id, bob_id = create_profiles(client)
+    generate(client, alice_id, bob_id)
+
+    response = client.put(f'/api/characters/{alice_id}', json={'name': 'Alice', 'setting': 'Alice is now a villain'})
+    assert response.status_code == 200
+    generate(client, alice_id, bob_id)
+
+    history = sorted(client.get('/api/history').get_json(), key=lambda item: item['id'])
+    assert [item['character1'] for item in history] == ['Alice is brave', 'Alice is now a villain']
+    assert [item['character2'] for item in history] == ['Bob is shy', 'Bob is shy']
+
+    exported = [json.loads(line) for line in client.get('/api/history/export').get_data(as_text=True).splitlines()]
+    assert [item['character1'] for item in sorted(exported, key=lambda item: item['id'])] == \
+        ['Alice is brave', 'Alice is now a villain']
+
+
+def test_history_keeps_edited_snapshot_after_profile_delete(client):
+    alice_id, bob_id = create_profiles(client)
+    generate(client, alice_id, bob_id)
+    client.put(f'/api/characters/{alice_id}', json={'name': 'Alice', 'setting': 'Alice is now a villain'})
+    generate(client, alice_id, bob_id)
+
+    assert client.delete(f'/api/characters/{alice_id}').status_code == 200
+
+    history = sorted(client.get('/api/history').get_json(), key=lambda item: item['id'])
+    assert [item['character1'] for item in history] == ['Alice is brave', 'Alice is now a villain']
+    assert [item['character1_id'] for item in history] == [None, None]
+
+
+def test_profile_outline_prompt_counts_cached_analyses_in_input_budget(client, monkeypatch):
+    monkeypatch.setattr(FakeModel, 'analysis', 'Alice, ' + 'very ' * 4000)
+    long_setting = 'brave ' * 6000
+    alice = client.post('/api/characters', json={'name': 'Alice', 'setting': long_setting}).get_json()
+    bob = client.post('/api/characters', json={'name': 'Bob', 'setting': long_setting}).get_json()
+
+    generate(client, alice['character']['id'], bob['character']['id'])
+
+    [outline_prompt] = FakeModel.outline_prompts
+    assert plot_ark.estimate_tokens(outline_prompt) <= plot_ark.TOKEN_BUDGETS['free']['max_input_tokens']
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# 结构化日志：慢请求耗时统计、错误采样与队列满时丢弃。
+import logging
+import queue
+import sys
+import time
+
+import pytest
+
+import app as plot_ark
+
+
+class CaptureHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def captured(monkeypatch):
+    handler = CaptureHandler()
+    plot_ark.logger.addHandler(handler)
+    monkeypatch.setattr(plot_ark, 'SLOW_REQUEST_MS', 0)
+    yield handler.records
+    plot_ark.logger.removeHandler(handler)
+
+
+def test_slow_request_log_for_streamed_export_covers_body(client, captured, monkeypatch):
+    def slow_ndjson(items):
+        list(items)
+        for line in ('{"id": 1}\n', '{"id": 2}\n'):
+            time.sleep(0.05)
+            yield line
+    monkeypatch.setattr(plot_ark, 'stream_history_ndjson', slow_ndjson)
+
+    response = client.get('/api/history/export')
+    assert not [record for record in captured if getattr(record, 'path', None) == '/api/history/export']
+    assert response.get_data(as_text=True) == '{"id": 1}\n{"id": 2}\n'
+    response.close()
+
+    [record] = [record for record in captured if getattr(record, 'path', None) == '/api/history/export']
+    assert record.status == 200
+    assert record.method == 'GET'
+    assert record.duration_ms >= 100
+    assert record.timings_ms['serialize'] >= 100
+    assert 'db' in record.timings_ms
+
+
+def test_slow_request_log_for_regular_response(client, captured):
+    assert client.get('/api/history').status_code == 200
+
+    [record] = [record for record in captured if getattr(record, 'path', None) == '/api/history']
+    assert record.status == 200
+    assert 'db' in record.timings_ms
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(plot_ark.time, 'monotonic', fake)
+    return fake
+
+
+@pytest.fixture
+def log_stats(monkeypatch):
+    stats = {'enqueued': 0, 'dropped': 0, 'sampled_out': 0}
+    monkeypatch.setattr(plot_ark, 'LOG_STATS', stats)
+    return stats
+
+
+def make_record(level=logging.ERROR, msg="模型调用失败"):
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        exc_info = sys.exc_info()
+    return logging.LogRecord('plot_ark', level, __file__, 1, msg, None, exc_info)
+
+
+def run_filter(sampler, count, **kwargs):
+    records = [make_record(**kwargs) for _ in range(count)]
+    return [record for record in records if sampler.filter(record)]
+
+
+def test_error_sampling_keeps_burst_then_one_in_n(clock, log_stats):
+    sampler = plot_ark.ErrorSamplingFilter()
+
+    passed = run_filter(sampler, 250)
+
+    burst = plot_ark.LOG_SAMPLE_BURST
+    assert len(passed) == burst + 2
+    assert all(not hasattr(record, 'suppressed') for record in passed[:burst])
+    assert [record.suppressed for record in passed[burst:]] == [100 - burst - 1, 99]
+    assert all(record.error_class == 'ValueError' for record in passed)
+    assert log_stats['sampled_out'] == 250 - len(passed)
+
+
+def test_error_sampling_carries_suppressed_count_into_next_window(clock, log_stats):
+    sampler = plot_ark.ErrorSamplingFilter()
+    run_filter(sampler, 50)
+    assert log_stats['sampled_out'] == 40
+
+    clock.now += plot_ark.LOG_SAMPLE_WINDOW_SECONDS
+    [record] = run_filter(sampler, 1)
+    assert record.suppressed == 40
+
+    # 新窗口重新获得完整的 burst 配额，且计数不会重复附带
+    passed = run_filter(sampler, plot_ark.LOG_SAMPLE_BURST - 1)
+    assert len(passed) == plot_ark.LOG_SAMPLE_BURST - 1
+    assert all(not hasattr(record, 'suppressed') for record in passed)
+
+
+def test_error_sampling_keys_by_message_and_ignores_warnings(clock, log_stats):
+    sampler = plot_ark.ErrorSamplingFilter()
+    run_filter(sampler, 50)
+
+    assert len(run_filter(sampler, 5, msg="数据库错误")) == 5
+    assert len(run_filter(sampler, 50, level=logging.WARNING)) == 50
+    assert log_stats['sampled_out'] == 40
+
+
+def test_queue_handler_drops_when_queue_is_full(log_stats):
+    log_queue = queue.Queue(maxsize=2)
+    handler = plot_ark.NonBlockingQueueHandler(log_queue)
+
+    for _ in range(5):
+        handler.handle(make_record())
+
+    assert log_stats == {'enqueued': 2, 'dropped': 3, 'sampled_out': 0}
+    record = log_queue.get_nowait()
+    assert record.exc_info is None
+    assert 'ValueError: boom' in record.exc_text
+    assert record.msg == "模型调用失败" and record.args is None
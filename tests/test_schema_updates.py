@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# 启动时的结构补齐：多个实例同时启动、都认为需要加列时，后执行的一方不应崩溃。
+import app as plot_ark
+
+
+def test_column_added_by_another_instance_is_tolerated(monkeypatch):
+    real_inspect = plot_ark.sa_inspect
+    stale_checks = {'prompt': 1} # 第一次检查 prompt 表时返回旧结构，模拟另一实例刚刚加完列
+
+    class StaleInspector:
+        def __init__(self, engine):
+            self._inspector = real_inspect(engine)
+
+        def get_columns(self, table):
+            columns = self._inspector.get_columns(table)
+            if stale_checks.get(table):
+                stale_checks[table] -= 1
+                return [c for c in columns if c['name'] != 'character1_id']
+            return columns
+
+        def get_indexes(self, table):
+            return self._inspector.get_indexes(table)
+
+    monkeypatch.setattr(plot_ark, 'sa_inspect', StaleInspector)
+    with plot_ark.app.app_context():
+        plot_ark.ensure_schema_updates()
+        columns = {c['name'] for c in real_inspect(plot_ark.db.engine).get_columns('prompt')}
+
+    assert stale_checks['prompt'] == 0
+    assert 'character1_id' in columns
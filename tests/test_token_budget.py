@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+# Token 预算：两个角色设定都超长时应自动压缩到剩余预算内，而不是直接拒绝。
+import pytest
+
+import app as plot_ark
+
+
+@pytest.fixture
+def summary_targets(monkeypatch):
+    targets = []
+
+    def fake_summarize(setting, max_tokens):
+        targets.append(max_tokens)
+        return plot_ark.truncate_to_tokens(setting, max_tokens)
+
+    monkeypatch.setattr(plot_ark, 'summarize_character_setting', fake_summarize)
+    return targets
+
+
+@pytest.mark.parametrize('tier', sorted(plot_ark.TOKEN_BUDGETS))
+def test_two_oversized_settings_are_summarized_within_input_budget(tier, summary_targets):
+    budget = plot_ark.TOKEN_BUDGETS[tier]
+    oversized = ' '.join(['word'] * 8000) # 约 10000 token，介于 max_setting_tokens 与各等级硬上限之间
+    oversized = plot_ark.truncate_to_tokens(oversized, budget['max_raw_setting_tokens'])
+
+    settings, error = plot_ark.apply_token_budget(oversized, oversized, 'they meet', budget)
+
+    assert error is None
+    assert len(summary_targets) == 2
+    assert all(plot_ark.MIN_SETTING_SUMMARY_TOKENS <= t <= budget['max_setting_tokens'] for t in summary_targets)
+    total_tokens = (plot_ark.PROMPT_TEMPLATE_TOKENS + plot_ark.estimate_tokens('they meet')
+                    + sum(plot_ark.estimate_tokens(s) for s in settings))
+    assert total_tokens <= budget['max_input_tokens']
+
+
+def test_short_setting_keeps_its_text_and_leaves_room_for_the_long_one(summary_targets):
+    budget = plot_ark.TOKEN_BUDGETS['free']
+    short_setting = 'Bob is shy'
+
+    settings, error = plot_ark.apply_token_budget('x' * 40000, short_setting, 'they meet', budget)
+
+    assert error is None
+    assert settings[1] == short_setting
+    assert summary_targets == [budget['max_setting_tokens']]
+
+
+def test_setting_over_raw_cap_is_rejected_before_any_summary(summary_targets):
+    budget = plot_ark.TOKEN_BUDGETS['guest']
+    too_large = 'x' * (budget['max_raw_setting_tokens'] * 4 + 8)
+
+    settings, error = plot_ark.apply_token_budget('x' * 8000, too_large, 'they meet', budget)
+
+    assert settings is None
+    assert error[0] == 'input_too_large'
+    assert summary_targets == []
+
+
+class FakeSummaryResponse:
+    def __init__(self, text, finish_reason):
+        self.text = text
+        self.parts = [text] if text else []
+        self.candidates = [type('Candidate', (), {'finish_reason': type('Reason', (), {'name': finish_reason})()})()]
+
+
+def use_summary_model(monkeypatch, response):
+    calls = []
+
+    class FakeModel:
+        def __init__(self, model_name):
+            pass
+
+        def generate_content(self, prompt, **kwargs):
+            calls.append(kwargs['generation_config']['max_output_tokens'])
+            return response
+
+    monkeypatch.setattr(plot_ark, 'GEMINI_API_KEY', 'test-key')
+    monkeypatch.setattr(plot_ark.genai, 'GenerativeModel', FakeModel)
+    monkeypatch.setattr(plot_ark, '_setting_summary_cache', plot_ark.OrderedDict())
+    return calls
+
+
+def test_summary_cut_off_at_max_tokens_falls_back_to_truncation_without_caching(monkeypatch):
+    calls = use_summary_model(monkeypatch, FakeSummaryResponse('Alice, a brave kn', 'MAX_TOKENS'))
+    setting = 'Alice ' * 2000
+
+    summary = plot_ark.summarize_character_setting(setting, 200)
+
+    assert summary == plot_ark.truncate_to_tokens(setting, 200)
+    assert calls == [200 * 2 + plot_ark.SETTING_SUMMARY_THINKING_TOKENS]
+    assert len(plot_ark._setting_summary_cache) == 0
+
+
+def test_completed_summary_is_cached(monkeypatch):
+    calls = use_summary_model(monkeypatch, FakeSummaryResponse('Alice, a brave knight.', 'STOP'))
+    setting = 'Alice ' * 2000
+
+    assert plot_ark.summarize_character_setting(setting, 200) == 'Alice, a brave knight.'
+    assert plot_ark.summarize_character_setting(setting, 200) == 'Alice, a brave knight.'
+    assert len(calls) == 1